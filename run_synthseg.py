@@ -3,15 +3,346 @@
 import argparse
 import numpy as np
 import os
+import runpy
 import shutil
 import SimpleITK as sitk
 import subprocess
+import sys
+
+# Extension for images that are written and then read back, uncompressed because gzip is slow and
+# single-threaded. User-facing outputs are always compressed
+INTERMEDIATE_EXT = os.environ.get('SYNTHSEG_TMP_EXT', '.nii')
+
+SYNTHSEG_PREDICT_SCRIPT = '/opt/SynthSeg/scripts/commands/SynthSeg_predict.py'
+
+# The device tensorflow was initialized on in this process, None if SynthSeg has not run here yet
+_synthseg_device = None
+
+# SynthSeg labels and the antsct labels they are converted to. The SynthSeg posteriors have one
+# channel per label, in this order
+LABEL_TO_ANTS = {
+    0: 0,  # background
+    2: 3,  # left_cerebral_white_matter
+    3: 2,  # left_cerebral_cortex
+    4: 1,  # left_lateral_ventricle
+    5: 1,  # left_inferior_lateral_ventricle
+    7: 6,  # left_cerebellum_white_matter
+    8: 6,  # left_cerebellum_cortex
+    10: 4,  # left_thalamus
+    11: 4,  # left_caudate
+    12: 4,  # left_putamen
+    13: 4,  # left_pallidum
+    14: 1,  # 3rd_ventricle
+    15: 1,  # 4th_ventricle
+    16: 5,  # brain-stem
+    17: 4,  # left_hippocampus
+    18: 4,  # left_amygdala
+    24: 1,  # CSF
+    26: 4,  # left_accumbens_area
+    28: 4,  # left_ventral_DC
+    41: 3,  # right_cerebral_white_matter
+    42: 2,  # right_cerebral_cortex
+    43: 1,  # right_lateral_ventricle
+    44: 1,  # right_inferior_lateral_ventricle
+    46: 6,  # right_cerebellum_white_matter
+    47: 6,  # right_cerebellum_cortex
+    49: 4,  # right_thalamus
+    50: 4,  # right_caudate
+    51: 4,  # right_putamen
+    52: 4,  # right_pallidum
+    53: 4,  # right_hippocampus
+    54: 4,  # right_amygdala
+    58: 4,  # right_accumbens_area
+    60: 4   # right_ventral_DC
+}
+
+# Lookup table indexed by SynthSeg label, so a label image is converted in one pass. The extra last
+# entry is background, clipping maps any label not in the table to it
+ANTS_LABEL_LUT = np.zeros(max(LABEL_TO_ANTS) + 2, dtype=np.uint8)
+
+# The antsct category (0-5) of each SynthSeg posterior channel, background is -1
+ANTS_POSTERIOR_CATEGORY = np.full(len(LABEL_TO_ANTS), -1, dtype=np.int8)
+
+for channel, (label, ants_label) in enumerate(LABEL_TO_ANTS.items()):
+    ANTS_LABEL_LUT[label] = ants_label
+    ANTS_POSTERIOR_CATEGORY[channel] = ants_label - 1
+
 
 class RawDefaultsHelpFormatter(
     argparse.RawDescriptionHelpFormatter, argparse.ArgumentDefaultsHelpFormatter
 ):
     pass
 
+
+def resample_to_1mm(image, interpolator=sitk.sitkBSpline):
+    """Resample an image to 1mm isotropic spacing, by default with cubic B-spline interpolation.
+
+    This does the same thing as ANTs ResampleImage with spacing 1x1x1 and interpolation type 4: the
+    output has the origin and direction of the input, covers the same physical extent, and is float.
+    """
+    spacing = (1.0, 1.0, 1.0)
+    size = [int(old_spacing * old_size / new_spacing + 0.5) for old_spacing, old_size, new_spacing in
+            zip(image.GetSpacing(), image.GetSize(), spacing)]
+    return sitk.Resample(image, size, sitk.Transform(), interpolator, image.GetOrigin(), spacing,
+                         image.GetDirection(), 0.0, sitk.sitkFloat32)
+
+
+def resample_to_reference(image, reference, interpolator):
+    """Resample an image onto the voxel grid of a 3D reference image, with an identity transform.
+
+    This replaces antsApplyTransforms with an Identity transform. A 4D image is resampled one volume at
+    a time, and keeps the origin and spacing of its 4th dimension, as with antsApplyTransforms -e 3.
+    """
+    if image.GetDimension() == 3:
+        return sitk.Resample(image, reference, sitk.Transform(), interpolator, 0.0, image.GetPixelID())
+
+    volumes = [sitk.Resample(image[:,:,:,t], reference, sitk.Transform(), interpolator, 0.0, image.GetPixelID())
+               for t in range(image.GetSize()[3])]
+    return sitk.JoinSeries(volumes, image.GetOrigin()[3], image.GetSpacing()[3])
+
+
+def run_synthseg_predict(synthseg_args, use_cpu):
+    """Run the SynthSeg prediction script with the given command line arguments.
+
+    The script runs in this process, so that tensorflow is imported and initialized once however many
+    times it is called. Tensorflow can't change device after it is initialized, so if a different
+    device is needed, or tensorflow can't be imported here, the script runs in a subprocess instead.
+    """
+    global _synthseg_device
+
+    device = 'cpu' if use_cpu else 'gpu'
+
+    if _synthseg_device is None or _synthseg_device == device:
+        # The script hides the GPU by setting CUDA_VISIBLE_DEVICES, restore it so it does not affect
+        # subprocesses launched later
+        cuda_visible_devices = os.environ.get('CUDA_VISIBLE_DEVICES')
+        argv = sys.argv
+        # The script finds the SynthSeg models relative to its own path in sys.argv[0]
+        sys.argv = [SYNTHSEG_PREDICT_SCRIPT] + synthseg_args
+        try:
+            runpy.run_path(SYNTHSEG_PREDICT_SCRIPT, run_name='__main__')
+            _synthseg_device = device
+            # The script builds a new model every time it runs, free it so memory does not grow over a
+            # batch. The script has imported tensorflow, so this does not import it
+            tf = sys.modules.get('tensorflow')
+            if tf is not None:
+                tf.keras.backend.clear_session()
+            return
+        except ImportError as e:
+            print(f"Could not run SynthSeg in process ({e}), running it in a subprocess", flush=True)
+        finally:
+            sys.argv = argv
+            if cuda_visible_devices is None:
+                os.environ.pop('CUDA_VISIBLE_DEVICES', None)
+            else:
+                os.environ['CUDA_VISIBLE_DEVICES'] = cuda_visible_devices
+
+    if _synthseg_device is not None and _synthseg_device != device:
+        print(f"WARNING: tensorflow is already initialized on {_synthseg_device.upper()} in this process, running "
+              f"SynthSeg on {device.upper()} in a subprocess", flush=True)
+    subprocess.run(['python', SYNTHSEG_PREDICT_SCRIPT] + synthseg_args)
+
+
+def read_list(list_file):
+    """Read a list of paths from a text file with one path per line, ignoring blank lines."""
+    with open(list_file) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def process_one(input_t1w, output_prefix, mask, args):
+    """Run SynthSeg and any post-processing on one input image.
+
+    The mask may be None. Other options come from the parsed command line arguments.
+    """
+    use_cpu = args.cpu
+
+    input_t1w = os.path.realpath(input_t1w)
+    output_prefix = os.path.realpath(output_prefix)
+
+    output_dir = os.path.dirname(output_prefix)
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    output_file_prefix = os.path.basename(output_prefix)
+
+    # Crop input data if applicable
+    synthseg_input = output_prefix + "SynthSegInput" + INTERMEDIATE_EXT
+
+    # Copy, the crop may be enlarged for this image
+    crop_params = list(args.crop)
+
+    # Crop and resample in memory, so the SynthSeg input is only written once. The original image is
+    # kept as the reference space for resampling the output
+    t1w_image = sitk.ReadImage(input_t1w)
+    input_image = t1w_image
+
+    if (mask is not None and os.path.isfile(mask)):
+        print(f"Cropping input image around mask", flush=True)
+
+        # Read the mask as uint8 directly, and get the bounding box of label 1 from the voxel array
+        mask_image = sitk.ReadImage(mask, sitk.sitkUInt8)
+        mask_voxels = sitk.GetArrayViewFromImage(mask_image) == 1
+
+        # bb = [ xMin, yMin, zMin, xSize, ySize, zSize ]. Numpy axes are (z, y, x), so reverse them
+        bb_vox = [0] * 6
+        for idx, axis in enumerate((2, 1, 0)):
+            other_axes = tuple(a for a in range(0,3) if a != axis)
+            nonzero = np.flatnonzero(mask_voxels.any(axis=other_axes))
+            if nonzero.size == 0:
+                raise ValueError(f"Brain mask {mask} does not contain any voxels labeled 1")
+            bb_vox[idx] = int(nonzero[0])
+            bb_vox[idx + 3] = int(nonzero[-1] - nonzero[0] + 1)
+
+        # Crop to the mask bounding box plus padding, within the image, as ExtractRegionFromImageByMask does
+        image_size = input_image.GetSize()
+        crop_index = [max(bb_vox[idx] - args.mask_pad, 0) for idx in range(0,3)]
+        crop_end = [min(bb_vox[idx] + bb_vox[idx + 3] + args.mask_pad, image_size[idx]) for idx in range(0,3)]
+        input_image = sitk.RegionOfInterest(input_image, [crop_end[idx] - crop_index[idx] for idx in range(0,3)],
+                                            crop_index)
+
+        # Check if mask fits inside crop area
+        bb_min_vox = tuple(bb_vox[0:3])
+        bb_max_vox = tuple(bb_vox[idx] + bb_vox[idx + 3] for idx in range(0,3))
+
+        bb_min_mm = mask_image.TransformIndexToPhysicalPoint(bb_min_vox)
+        bb_max_mm = mask_image.TransformIndexToPhysicalPoint(bb_max_vox)
+
+        # The length of the sides of the bounding box in physical coordinates
+        # ITK uses LPS but lengths of the BB are the same as NIFTI RAS
+        bb_extent_ras = [round(abs(max_mm - min_mm)) for max_mm, min_mm in zip(bb_max_mm, bb_min_mm)]
+
+        for idx in range(0,3):
+            if bb_extent_ras[idx] > args.crop[idx]:
+                print("WARNING: brain mask extent is larger than cropped region for synthseg, " +
+                    "using CPU to avoid running out of memory", flush=True)
+                # Crop must be a multiple of 32
+                crop_params[idx] = crop_params[idx] + 32
+                use_cpu = True
+
+    if os.path.realpath(synthseg_input) == input_t1w:
+        raise ValueError(f"Input image {input_t1w} would be overwritten by the SynthSeg input, use a different "
+                         "output prefix")
+
+    # Remove any previous SynthSeg input rather than writing over it, in case it is linked to another file
+    if os.path.lexists(synthseg_input):
+        os.remove(synthseg_input)
+
+    if np.allclose(input_image.GetSpacing(), 1.0):
+        # Already 1mm, so resampling would not change the image. If it was not cropped either, and is
+        # stored the same way as the SynthSeg input, copy the file rather than encoding it again
+        if input_image is t1w_image and input_t1w.endswith(INTERMEDIATE_EXT):
+            shutil.copyfile(input_t1w, synthseg_input)
+        else:
+            sitk.WriteImage(input_image, synthseg_input)
+        print(f"Input image: {input_t1w} is already 1mm, written to {synthseg_input}")
+    else:
+        # Resample to 1mm, in process rather than calling ResampleImage, to save the process launch
+        resample_interpolator = sitk.sitkLinear if args.resample_order == 1 else sitk.sitkBSpline
+        sitk.WriteImage(resample_to_1mm(input_image, resample_interpolator), synthseg_input)
+        print(f"Input image: {input_t1w} resampled to {synthseg_input}")
+
+    output_seg = output_prefix + 'SynthSeg.nii.gz'
+
+    synthseg_args = ['--i', synthseg_input, '--o', output_seg, '--crop'] + [str(c) for c in crop_params]
+
+    # Set up synthseg options
+    if (args.post):
+        post_output_file = output_prefix + 'Posteriors.nii.gz'
+        synthseg_args.extend(['--post', post_output_file])
+    elif (args.antsct):
+        # Posteriors are only needed to make PosteriorsOrig, write them as a temporary file
+        post_output_file = output_prefix + 'Posteriors' + INTERMEDIATE_EXT
+        synthseg_args.extend(['--post', post_output_file])
+    if (args.qc):
+        qc_output_file = output_prefix + 'QC.csv'
+        synthseg_args.extend(['--qc', qc_output_file])
+    if (args.vol):
+        vol_output_file = output_prefix + 'Volumes.csv'
+        synthseg_args.extend(['--vol', vol_output_file])
+    if (args.parc):
+        synthseg_args.append('--parc')
+    if (args.robust):
+        synthseg_args.append('--robust')
+    if (use_cpu):
+        synthseg_args.append('--cpu')
+
+    # Now call synthseg
+    print(f"Running synthseg on {synthseg_input}", flush=True)
+    print(f"synthseg args: {synthseg_args}", flush=True)
+    run_synthseg_predict(synthseg_args, use_cpu)
+
+    if args.resample_orig or args.antsct:
+        print("Resampling output to input orig space")
+        label_interpolator = getattr(sitk, 'sitk' + args.label_interp)
+        # Keep the resampled images, so the antsct conversion does not have to read them back
+        synthseg_orig = resample_to_reference(sitk.ReadImage(output_seg), t1w_image, label_interpolator)
+        sitk.WriteImage(synthseg_orig, output_prefix + 'SynthSegOrig.nii.gz')
+        if args.post or args.antsct:
+            posteriors_orig = resample_to_reference(sitk.ReadImage(post_output_file), t1w_image, sitk.sitkLinear)
+            sitk.WriteImage(posteriors_orig, output_prefix + 'PosteriorsOrig.nii.gz')
+            if not args.post:
+                os.remove(post_output_file)
+        if args.parc:
+            parc_file = output_prefix + 'CorticalParcellation.nii.gz'
+            if os.path.isfile(parc_file):
+                sitk.WriteImage(resample_to_reference(sitk.ReadImage(parc_file), t1w_image, label_interpolator),
+                                output_prefix + 'CorticalParcellationOrig.nii.gz')
+            else:
+                print(f"WARNING: cortical parcellation {parc_file} not found, not resampling it", flush=True)
+
+        # If requested, output in antsct format
+        if args.antsct:
+            print("Outputting in antsct format")
+            synthseg_labels = synthseg_orig
+
+            synthseg_array = sitk.GetArrayViewFromImage(synthseg_labels)
+
+            # Convert to antsct labels
+            output_array = np.take(ANTS_LABEL_LUT, synthseg_array.astype(np.intp), mode='clip')
+
+            output_image = sitk.GetImageFromArray(output_array)
+            output_image.SetOrigin(synthseg_labels.GetOrigin())
+            output_image.SetSpacing(synthseg_labels.GetSpacing())
+            output_image.SetDirection(synthseg_labels.GetDirection())
+
+            sitk.WriteImage(output_image, output_prefix + 'SynthSegToAntsCT.nii.gz')
+
+            prob_image = posteriors_orig
+
+            # Get a numpy view of the probability image, no copy unless it needs converting to float32.
+            # The 4D image is (channel, z, y, x) in numpy, so each channel is a contiguous block
+            prob_array = sitk.GetArrayViewFromImage(prob_image).astype(np.float32, copy=False)
+
+            # Category probabilities for ants posteriors, one volume per category
+            ants_probs = np.zeros((6,) + prob_array.shape[1:], dtype=np.float32)
+
+            # Add the probabilities of each channel to its ants category. In-place accumulation is faster
+            # than np.add.at, which is unbuffered, and avoids copying channels with fancy indexing
+            for idx, category in enumerate(ANTS_POSTERIOR_CATEGORY):
+                if category >= 0:
+                    ants_probs[category] += prob_array[idx]
+
+            if args.antsct_4d:
+                # One 4D image with a volume per category, like PosteriorsOrig
+                ants_posterior = sitk.GetImageFromArray(ants_probs, isVector=False)
+                # Use 3D synthseg_labels for header info, with unit spacing and identity direction in 4D
+                direction = synthseg_labels.GetDirection()
+                ants_posterior.SetOrigin(synthseg_labels.GetOrigin() + (0.0,))
+                ants_posterior.SetSpacing(synthseg_labels.GetSpacing() + (1.0,))
+                ants_posterior.SetDirection(direction[0:3] + (0.0,) + direction[3:6] + (0.0,) + direction[6:9] +
+                                            (0.0, 0.0, 0.0, 0.0, 1.0))
+                sitk.WriteImage(ants_posterior, output_prefix + 'AntsctPosteriors.nii.gz')
+            else:
+                for i, category_prob in enumerate(ants_probs):
+                    ants_posterior = sitk.GetImageFromArray(category_prob)
+                    # Use 3D synthseg_labels for header info
+                    ants_posterior.SetOrigin(synthseg_labels.GetOrigin())
+                    ants_posterior.SetSpacing(synthseg_labels.GetSpacing())
+                    ants_posterior.SetDirection(synthseg_labels.GetDirection())
+                    sitk.WriteImage(ants_posterior, output_prefix + 'AntsctPosteriors' + str(i + 1) + '.nii.gz')
+
+
 parser = argparse.ArgumentParser(formatter_class=RawDefaultsHelpFormatter,
                                  prog="synthseg brain segmentation", add_help = False, description='''
 Wrapper for brain segmentation using synthseg.
@@ -20,7 +351,8 @@ By default, synthseg input images are resampled to 1mm and cropped to 192 mm^3 a
 the image.
 
 In this container, the input image is automatically resampled to 1mm isotropic resolution with
-b-spline interpolation.
+cubic b-spline interpolation. SynthSeg is trained to be robust to resolution and contrast, so linear
+interpolation (--resample-order 1) is a faster alternative.
 
 It is recommended that the user provide a brain mask, in which case the image is cropped and
 resampled about the mask bounding box. This should ensure that the synthseg region of interest
@@ -35,9 +367,12 @@ A brain mask can be computed quickly and robustly with SynthStrip.
 For output, specify a prefix with --output. Optional outputs are written to the same prefix with the
 appropriate suffixes, explained below.
 
+The SynthSegInput image is read back during processing, so it is written uncompressed (.nii) to save
+time. Set the environment variable SYNTHSEG_TMP_EXT=.nii.gz to compress it.
+
 Output suffixes:
 
-  SynthSegInput.nii.gz - The resampled image used as input for SynthSeg. If a brain mask is used,
+  SynthSegInput.nii - The resampled image used as input for SynthSeg. If a brain mask is used,
   this image will also be cropped to the bounding box of the mask plus a constant padding, before
   running SynthSeg. Otherwise, the original image is resampled to 1mm resolution.
 
@@ -61,15 +396,26 @@ Optional output suffixes:
 
 ''')
 
-required = parser.add_argument_group('Required arguments')
-required.add_argument('--input', help='Input structural image', type=str, required=True)
-required.add_argument('--output', help='Output prefix', type=str, required=True)
+required = parser.add_argument_group('Required arguments', 'Either --input and --output, or --input-list and '
+                                     '--output-list')
+required.add_argument('--input', help='Input structural image', type=str)
+required.add_argument('--output', help='Output prefix', type=str)
+required.add_argument('--input-list', help='Text file listing input structural images, one per line. All images are '
+                      'processed in one process, so tensorflow is only loaded once', type=str)
+required.add_argument('--output-list', help='Text file listing an output prefix for each image in --input-list',
+                      type=str)
 optional = parser.add_argument_group('Optional arguments')
 optional.add_argument('-h', '--help', action='help', help='show this help message and exit')
 optional.add_argument('--mask', help='Brain mask about which to crop the input image', type=str)
+optional.add_argument('--mask-list', help='Text file listing a brain mask for each image in --input-list', type=str)
 optional.add_argument('--mask-pad', help='Padding around brain mask, in voxels', type=int, default = 32)
+optional.add_argument('--resample-order', help='Interpolation order for resampling the input to 1mm, 1 for '
+                      'linear or 3 for cubic b-spline', type=int, choices=[1, 3], default=3)
 optional.add_argument('--resample-orig', action='store_true', help='Resample the output images to the original space. '
                       'This is a post-processing step, all QC / volume measures are computed in the 1mm space.')
+optional.add_argument('--label-interp', help='Interpolation for resampling label images to the original space. '
+                      'LabelGaussian is slower, but smoother where the original voxels are much smaller than 1mm',
+                      choices=['NearestNeighbor', 'LabelGaussian'], default='NearestNeighbor')
 synthseg = parser.add_argument_group('SynthSeg arguments')
 synthseg.add_argument('--cpu', action='store_true', help='Use CPU instead of GPU, even if GPU is available')
 synthseg.add_argument('--crop', help='Crop parameters, must be multiples of 32. If increasing beyond the default, '
@@ -79,193 +425,72 @@ synthseg.add_argument('--post', action='store_true', help='Output a multi-compon
                       'probabilities')
 synthseg.add_argument('--parc', action='store_true', help='Do cortical parcellation')
 optional.add_argument('--antsct', action='store_true', help='Output results in antsct format (implies --resample-orig '
-                      'and --post)')
+                      'and writes PosteriorsOrig.nii.gz, Posteriors.nii.gz is only kept with --post)')
+optional.add_argument('--antsct-4d', action='store_true', help='Write the antsct posteriors to a single 4D image '
+                      'AntsctPosteriors.nii.gz, instead of one image per class. This is faster to write')
 synthseg.add_argument('--qc', action='store_true', help='Output a CSV file containing QC measures')
 synthseg.add_argument('--robust', action='store_true', help='Use robust fitting for low-resolution or other challenging data')
 synthseg.add_argument('--vol', action='store_true', help='Output a CSV file containing label volumes')
 
-args = parser.parse_args()
-
-# These control multi-threading for basic operations, set to 1 because they don't take much time
-# You can separately control tensorflow threads in the call to synthseg, but this might increase the
-# already substantial memory requirements, so that's not currently an option
-os.environ['OMP_NUM_THREADS'] = "1"
-os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = "1"
-
-use_cpu = args.cpu
-
-input_t1w = os.path.realpath(args.input)
-output_prefix = os.path.realpath(args.output)
-
-output_dir = os.path.dirname(output_prefix)
-
-if not os.path.isdir(output_dir):
-    os.makedirs(output_dir)
-
-output_file_prefix = os.path.basename(output_prefix)
-
-# Crop input data if applicable
-synthseg_input = output_prefix + "SynthSegInput.nii.gz"
-
-crop_params = args.crop
-
-if (args.mask is not None and os.path.isfile(args.mask)):
-    print(f"Cropping input image around mask", flush=True)
-    subprocess.run(['ExtractRegionFromImageByMask', '3', input_t1w, synthseg_input, args.mask, str(1), str(args.mask_pad)])
-
-    # Check if mask fits inside crop area
-    mask_image = sitk.ReadImage(args.mask)
-    label_shape = sitk.LabelShapeStatisticsImageFilter()
-    label_shape.Execute(sitk.Cast(mask_image, sitk.sitkUInt8))
-    # bb = [ xMin, yMin, zMin, xSize, ySize, zSize ]
-    bb_vox = label_shape.GetBoundingBox(1)
-
-    bb_min_vox = bb_vox[0:3]
-    bb_max_vox = tuple([int(b) for b in np.add(bb_vox[0:3], bb_vox[3:6])])
-
-    bb_min_mm = mask_image.TransformIndexToPhysicalPoint(bb_min_vox)
-    bb_max_mm = mask_image.TransformIndexToPhysicalPoint(bb_max_vox)
-
-    # The length of the sides of the bounding box in physical coordinates
-    # ITK uses LPS but lengths of the BB are the same as NIFTI RAS
-    bb_extent_ras = np.round(np.abs(np.subtract(bb_max_mm, bb_min_mm)))
-
-    for idx in range(0,3):
-        if bb_extent_ras[idx] > args.crop[idx]:
-            print("WARNING: brain mask extent is larger than cropped region for synthseg, " +
-                "using CPU to avoid running out of memory", flush=True)
-            # Crop must be a multiple of 32
-            crop_params[idx] = crop_params[idx] + 32
-            use_cpu = True
-
-else:
-    shutil.copyfile(input_t1w, synthseg_input)
-
-# Resample to 1mm
-subprocess.run(['ResampleImage', '3', synthseg_input, synthseg_input, '1x1x1', '0', '4'])
-
-print(f"Input image: {input_t1w} resampled to {synthseg_input}")
-
-output_seg = output_prefix + 'SynthSeg.nii.gz'
-
-synthseg_args = ['--i', synthseg_input, '--o', output_seg, '--crop'] + [str(c) for c in crop_params]
-
-# Set up synthseg options
-if (args.post):
-    post_output_file = output_prefix + 'Posteriors.nii.gz'
-    synthseg_args = synthseg_args + ['--post', post_output_file]
-if (args.qc):
-    qc_output_file = output_prefix + 'QC.csv'
-    synthseg_args = synthseg_args + ['--qc', qc_output_file]
-if (args.vol):
-    vol_output_file = output_prefix + 'Volumes.csv'
-    synthseg_args = synthseg_args + ['--vol', vol_output_file]
-if (args.parc):
-    synthseg_args = synthseg_args + ['--parc']
-if (args.robust):
-    synthseg_args = synthseg_args + ['--robust']
-if (use_cpu):
-    synthseg_args = synthseg_args + ['--cpu']
-
-# Now call synthseg
-print(f"Running synthseg on {synthseg_input}", flush=True)
-print(f"synthseg args: {synthseg_args}", flush=True)
-subprocess.run(['python', '/opt/SynthSeg/scripts/commands/SynthSeg_predict.py'] + synthseg_args)
-
-if args.resample_orig or args.antsct:
-    print("Resampling output to input orig space")
-    subprocess.run(['antsApplyTransforms', '-d', '3', '-i', output_seg, '-o',
-                    output_prefix + 'SynthSegOrig.nii.gz', '-t', 'Identity', '-r', input_t1w, '-n',
-                    'GenericLabel', '--verbose'])
-    if args.post or args.antsct:
-        subprocess.run(['antsApplyTransforms', '-d', '3', '-e', '3', '-i', post_output_file, '-o',
-                        output_prefix + 'PosteriorsOrig.nii.gz', '-t', 'Identity', '-r', input_t1w, '--verbose'])
-    if args.parc:
-        subprocess.run(['antsApplyTransforms', '-d', '3', '-i', output_prefix + 'CorticalParcellation.nii.gz', '-o',
-                        output_prefix + 'CorticalParcellationOrig.nii.gz', '-t', 'Identity', '-r', input_t1w, '-n',
-                        'GenericLabel', '--verbose'])
-
-    # If requested, output in antsct format
-    if args.antsct:
-        print("Outputting in antsct format")
-        synthseg_labels = sitk.ReadImage(output_prefix + 'SynthSegOrig.nii.gz')
-
-        # Convert to antsct labels
-        label_to_ants = {
-            0: 0,  # background
-            2: 3,  # left_cerebral_white_matter
-            3: 2,  # left_cerebral_cortex
-            4: 1,  # left_lateral_ventricle
-            5: 1,  # left_inferior_lateral_ventricle
-            7: 6,  # left_cerebellum_white_matter
-            8: 6,  # left_cerebellum_cortex
-            10: 4,  # left_thalamus
-            11: 4,  # left_caudate
-            12: 4,  # left_putamen
-            13: 4,  # left_pallidum
-            14: 1,  # 3rd_ventricle
-            15: 1,  # 4th_ventricle
-            16: 5,  # brain-stem
-            17: 4,  # left_hippocampus
-            18: 4,  # left_amygdala
-            24: 1,  # CSF
-            26: 4,  # left_accumbens_area
-            28: 4,  # left_ventral_DC
-            41: 3,  # right_cerebral_white_matter
-            42: 2,  # right_cerebral_cortex
-            43: 1,  # right_lateral_ventricle
-            44: 1,  # right_inferior_lateral_ventricle
-            46: 6,  # right_cerebellum_white_matter
-            47: 6,  # right_cerebellum_cortex
-            49: 4,  # right_thalamus
-            50: 4,  # right_caudate
-            51: 4,  # right_putamen
-            52: 4,  # right_pallidum
-            53: 4,  # right_hippocampus
-            54: 4,  # right_amygdala
-            58: 4,  # right_accumbens_area
-            60: 4   # right_ventral_DC
-        }
-
-        synthseg_array = sitk.GetArrayFromImage(synthseg_labels)
-
-        output_array = np.zeros_like(synthseg_array)
-
-        for label, ants_label in label_to_ants.items():
-            output_array[synthseg_array == label] = ants_label
-
-        output_image = sitk.GetImageFromArray(output_array)
-        output_image.SetOrigin(synthseg_labels.GetOrigin())
-        output_image.SetSpacing(synthseg_labels.GetSpacing())
-        output_image.SetDirection(synthseg_labels.GetDirection())
-
-        sitk.WriteImage(output_image, output_prefix + 'SynthSegToAntsCT.nii.gz')
-
-        prob_image = sitk.ReadImage(output_prefix + 'PosteriorsOrig.nii.gz')
-
-        # Get the numpy array from the probability image
-        prob_array = sitk.GetArrayFromImage(prob_image)
-
-        # Initialize a list of arrays for category probabilities, for ants posteriors
-        ants_probs = [np.zeros(prob_array.shape[1:], dtype=prob_array.dtype) for _ in range(6)]
-
-        # Sum of probabilities for all categories, use this to label
-        sum_probs = np.zeros(prob_array.shape[1:], dtype=prob_array.dtype)
-
-        # Iterate over the labels and add probabilities to the corresponding ants categories
-        for idx, label in enumerate(label_to_ants.keys()):
-            if (label == 0):
-                continue
-            category = label_to_ants[label]
-            ants_probs[category - 1] += prob_array[idx]
-
-        for i, category_prob in enumerate(ants_probs):
-            ants_posterior = sitk.GetImageFromArray(category_prob)
-            # Use 3D synthseg_labels for header info
-            ants_posterior.SetOrigin(synthseg_labels.GetOrigin())
-            ants_posterior.SetSpacing(synthseg_labels.GetSpacing())
-            ants_posterior.SetDirection(synthseg_labels.GetDirection())
-            sitk.WriteImage(ants_posterior, output_prefix + 'AntsctPosteriors' + str(i + 1) + '.nii.gz')
-
-
-
+def check_args(args):
+    """Check that parsed arguments name either a single image or lists of images.
+
+    Raises ValueError if they do not.
+    """
+    if args.input_list is not None:
+        if args.input is not None or args.output is not None or args.mask is not None:
+            raise ValueError('--input, --output and --mask cannot be used with --input-list')
+        if args.output_list is None:
+            raise ValueError('--output-list is required with --input-list')
+    else:
+        if args.output_list is not None or args.mask_list is not None:
+            raise ValueError('--output-list and --mask-list require --input-list')
+        if args.input is None or args.output is None:
+            raise ValueError('--input and --output are required')
+
+
+def run(args):
+    """Process the images given by parsed command line arguments.
+
+    This is the entry point for drivers that run several jobs in one process, so the parser, SimpleITK
+    and tensorflow are only initialized once. Arguments from parser.parse_args() are checked with
+    check_args(), which raises ValueError if they are incomplete.
+    """
+    check_args(args)
+
+    # These control multi-threading for basic operations, set to 1 because they don't take much time
+    # You can separately control tensorflow threads in the call to synthseg, but this might increase the
+    # already substantial memory requirements, so that's not currently an option
+    os.environ['OMP_NUM_THREADS'] = "1"
+    os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = "1"
+
+    if args.input_list is not None:
+        input_images = read_list(args.input_list)
+        output_prefixes = read_list(args.output_list)
+        masks = read_list(args.mask_list) if args.mask_list is not None else [None] * len(input_images)
+        if not len(input_images) == len(output_prefixes) == len(masks):
+            raise ValueError('--input-list, --output-list and --mask-list must have the same number of entries')
+    else:
+        input_images = [args.input]
+        output_prefixes = [args.output]
+        masks = [args.mask]
+
+    # All images are processed in this process, so that tensorflow is only initialized once
+    for input_t1w, output_prefix, mask in zip(input_images, output_prefixes, masks):
+        process_one(input_t1w, output_prefix, mask, args)
+
+
+def main(argv=None):
+    """Parse command line arguments, from sys.argv by default, and run."""
+    args = parser.parse_args(argv)
+
+    try:
+        check_args(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    run(args)
+
+
+if __name__ == '__main__':
+    main()